@@ -1,118 +1,285 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import sqlite3
-from datetime import datetime, timedelta
+import threading
+import atexit
+import csv
+from datetime import datetime
 import uuid
 import plotly.express as px
 
-# Initialize SQLite database
-conn = sqlite3.connect('shop.db')
+# Stock status thresholds and labels, shared by the pandas and SQL classifiers
+LOW_STOCK_THRESHOLD = 5
+STOCK_STATUSES = ['Out of Stock', 'Low Stock', 'In Stock']
+STOCK_STATUS_SQL = (f"CASE WHEN quantity = 0 THEN '{STOCK_STATUSES[0]}' "
+                    f"WHEN quantity < {LOW_STOCK_THRESHOLD} THEN '{STOCK_STATUSES[1]}' "
+                    f"ELSE '{STOCK_STATUSES[2]}' END")
+
+# Maximum number of rows the product search displays
+SEARCH_LIMIT = 200
+
+# Initialize SQLite database once per server process and reuse it across reruns
+@st.cache_resource
+def get_conn():
+    c = sqlite3.connect('shop.db', check_same_thread=False)
+    atexit.register(c.close)
+    c.execute('PRAGMA journal_mode=WAL')
+    c.execute('PRAGMA synchronous=NORMAL')
+    c.execute('PRAGMA temp_store=MEMORY')
+    c.execute('PRAGMA mmap_size=268435456')
+
+    # Create tables if they don't exist
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS products (
+            id TEXT PRIMARY KEY,
+            name TEXT,
+            price REAL,
+            quantity INTEGER,
+            name_folded TEXT
+        )
+    ''')
+    # SQLite LIKE only folds ASCII case, so searches match a casefolded copy of the name
+    if 'name_folded' not in [row[1] for row in c.execute('PRAGMA table_info(products)')]:
+        c.execute('ALTER TABLE products ADD COLUMN name_folded TEXT')
+        c.executemany('UPDATE products SET name_folded = ? WHERE id = ?',
+                      [(name.casefold(), product_id) for product_id, name in c.execute('SELECT id, name FROM products')])
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS sales (
+            id TEXT PRIMARY KEY,
+            product_id TEXT,
+            quantity_sold INTEGER,
+            sale_date TEXT,
+            sale_ts INTEGER,
+            FOREIGN KEY (product_id) REFERENCES products(id)
+        )
+    ''')
+    # Older databases predate sale_ts; add it and backfill from sale_date (local time)
+    if 'sale_ts' not in [row[1] for row in c.execute('PRAGMA table_info(sales)')]:
+        c.execute('ALTER TABLE sales ADD COLUMN sale_ts INTEGER')
+        c.execute("UPDATE sales SET sale_ts = CAST(strftime('%s', sale_date, 'utc') AS INTEGER)")
+    # No query filters on sale_date any more; drop the index left by earlier versions
+    c.execute('DROP INDEX IF EXISTS idx_sales_date')
+    # Covers the 30-day velocity query as an index range scan
+    c.execute('CREATE INDEX IF NOT EXISTS idx_sales_ts ON sales(sale_ts, product_id, quantity_sold)')
+    c.commit()
+    return c
+
+# Sessions share the connection, so write transactions are serialized to keep
+# one session's commit or rollback from covering another's statements
+@st.cache_resource
+def get_write_lock():
+    return threading.Lock()
+
+conn = get_conn()
+write_lock = get_write_lock()
 cursor = conn.cursor()
 
-# Create tables if they don't exist
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS products (
-        id TEXT PRIMARY KEY,
-        name TEXT,
-        price REAL,
-        quantity INTEGER
-    )
-''')
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS sales (
-        id TEXT PRIMARY KEY,
-        product_id TEXT,
-        quantity_sold INTEGER,
-        sale_date TEXT,
-        FOREIGN KEY (product_id) REFERENCES products(id)
-    )
-''')
-conn.commit()
+# Shared by every session and bumped on every write, so cached query results
+# are invalidated process-wide
+@st.cache_resource
+def get_db_version():
+    return {'value': 0, 'lock': threading.Lock()}
+
+def db_version():
+    return get_db_version()['value']
+
+def bump_db_version():
+    version = get_db_version()
+    with version['lock']:
+        version['value'] += 1
 
 # Function to add a new product
 def add_product(name, price, quantity):
-    product_id = str(uuid.uuid4())
-    cursor.execute('INSERT INTO products (id, name, price, quantity) VALUES (?, ?, ?, ?)',
-                  (product_id, name, price, quantity))
-    conn.commit()
+    product_id = uuid.uuid4().hex
+    with write_lock, conn:
+        cursor.execute('INSERT INTO products (id, name, price, quantity, name_folded) VALUES (?, ?, ?, ?, ?)',
+                      (product_id, name, price, quantity, name.casefold()))
+    bump_db_version()
     st.success(f"Product '{name}' added successfully!")
 
+# Function to add many products in a single transaction
+def bulk_add_products(rows):
+    rows = [(uuid.uuid4().hex, name, price, quantity, name.casefold()) for name, price, quantity in rows]
+    with write_lock, conn:
+        cursor.executemany('INSERT INTO products (id, name, price, quantity, name_folded) VALUES (?, ?, ?, ?, ?)', rows)
+    bump_db_version()
+    st.success(f"{len(rows)} products added successfully!")
+
 # Function to get all products
-def get_products():
-    cursor.execute('SELECT * FROM products')
-    df = pd.DataFrame(cursor.fetchall(), columns=['ID', 'Name', 'Price', 'Quantity'])
-    df['Stock Status'] = df['Quantity'].apply(
-        lambda x: 'Out of Stock' if x == 0 else 'Low Stock' if x < 5 else 'In Stock'
+@st.cache_data(max_entries=4)
+def get_products(version):
+    df = pd.read_sql_query('''
+        SELECT id AS "ID", name AS "Name", price AS "Price", quantity AS "Quantity"
+        FROM products
+    ''', conn, dtype={'Price': 'float64', 'Quantity': 'int64'})
+    return add_stock_status(df)
+
+# Function to search products by name, filtered in SQL
+@st.cache_data(max_entries=4)
+def search_products(version, q, limit=SEARCH_LIMIT):
+    df = pd.read_sql_query('''
+        SELECT id AS "ID", name AS "Name", price AS "Price", quantity AS "Quantity"
+        FROM products
+        WHERE name_folded LIKE ? ESCAPE '\\'
+        LIMIT ?
+    ''', conn, params=(like_pattern(q), limit), dtype={'Price': 'float64', 'Quantity': 'int64'})
+    return add_stock_status(df)
+
+# Build a LIKE pattern matching casefolded q anywhere, with wildcards in q escaped
+def like_pattern(q):
+    q = q.casefold()
+    return '%' + q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+# Classify each product's stock level
+def add_stock_status(df):
+    q = df['Quantity'].to_numpy()
+    df['Stock Status'] = pd.Categorical.from_codes(
+        np.select([q == 0, q < LOW_STOCK_THRESHOLD], [0, 1], default=2).astype('int8'),
+        categories=STOCK_STATUSES
     )
     return df
 
 # Function to record a sale
 def record_sale(product_id, quantity_sold):
-    sale_id = str(uuid.uuid4())
-    sale_date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    cursor.execute('INSERT INTO sales (id, product_id, quantity_sold, sale_date) VALUES (?, ?, ?, ?)',
-                  (sale_id, product_id, quantity_sold, sale_date))
-    cursor.execute('UPDATE products SET quantity = quantity - ? WHERE id = ?', (quantity_sold, product_id))
-    conn.commit()
+    sale_id = uuid.uuid4().hex
+    now = datetime.now()
+    sale_date = now.strftime('%Y-%m-%d %H:%M:%S')
+    sale_ts = int(now.timestamp())
+    with write_lock, conn:
+        # Decrement only if enough stock is left, so the check and update are atomic
+        cursor.execute('UPDATE products SET quantity = quantity - ? WHERE id = ? AND quantity >= ? RETURNING quantity',
+                      (quantity_sold, product_id, quantity_sold))
+        if cursor.fetchone() is None:
+            cursor.execute('SELECT quantity FROM products WHERE id = ?', (product_id,))
+            st.error(f"Insufficient stock! Available: {cursor.fetchone()[0]}")
+            return
+        cursor.execute('INSERT INTO sales (id, product_id, quantity_sold, sale_date, sale_ts) VALUES (?, ?, ?, ?, ?)',
+                      (sale_id, product_id, quantity_sold, sale_date, sale_ts))
+    bump_db_version()
     st.success("Sale recorded successfully!")
 
 # Function to get sales data
-def get_sales():
-    cursor.execute('''
-        SELECT s.id, p.name, s.quantity_sold, s.sale_date, p.price
+@st.cache_data(max_entries=4)
+def get_sales(version):
+    df = pd.read_sql_query('''
+        SELECT s.id AS "Sale ID", p.name AS "Name", s.quantity_sold AS "Quantity Sold", s.sale_date AS "Sale Date",
+               p.price AS "Price", s.quantity_sold * p.price AS "Revenue"
         FROM sales s
         JOIN products p ON s.product_id = p.id
-    ''')
-    df = pd.DataFrame(cursor.fetchall(), columns=['Sale ID', 'Name', 'Quantity Sold', 'Sale Date', 'Price'])
-    df['Revenue'] = df['Quantity Sold'] * df['Price']  # Add Revenue column
+    ''', conn, dtype={'Name': 'category', 'Quantity Sold': 'int64', 'Price': 'float64', 'Revenue': 'float64'})
     return df
 
+# Function to stream a query result straight into a CSV file
+def export_csv(path, query, params=()):
+    cursor.execute(query, params)
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow([d[0] for d in cursor.description])
+        writer.writerows(cursor)
+
+# Function to export the inventory, optionally filtered by a name search
+def export_inventory(path, search=''):
+    export_csv(path, f'''
+        SELECT id AS "ID", name AS "Name", price AS "Price", quantity AS "Quantity",
+               {STOCK_STATUS_SQL} AS "Stock Status"
+        FROM products
+        WHERE name_folded LIKE ? ESCAPE '\\'
+    ''', (like_pattern(search),))
+
+# Function to export the sales history
+def export_sales(path):
+    export_csv(path, '''
+        SELECT s.id AS "Sale ID", p.name AS "Name", s.quantity_sold AS "Quantity Sold", s.sale_date AS "Sale Date",
+               p.price AS "Price", s.quantity_sold * p.price AS "Revenue"
+        FROM sales s
+        JOIN products p ON s.product_id = p.id
+    ''')
+
 # Function to get weekly sales
-def get_weekly_sales():
-    sales = get_sales()
-    sales['Sale Date'] = pd.to_datetime(sales['Sale Date'])
-    sales['Week'] = sales['Sale Date'].dt.isocalendar().week
-    sales['Year'] = sales['Sale Date'].dt.year
-    weekly = sales.groupby(['Year', 'Week']).agg({
-        'Quantity Sold': 'sum',
-        'Revenue': 'sum'
-    }).reset_index()
-    weekly['Week Start'] = sales.groupby(['Year', 'Week'])['Sale Date'].min().dt.strftime('%Y-%m-%d').values
+@st.cache_data(max_entries=4)
+def get_weekly_sales(version):
+    cursor.execute('''
+        SELECT CAST(strftime('%Y', s.sale_date) AS INTEGER) AS year,
+               -- ISO week number: day of year of the Thursday in the same Monday-based week
+               (CAST(strftime('%j', date(s.sale_date, '-3 days', 'weekday 4')) AS INTEGER) - 1) / 7 + 1 AS week,
+               SUM(s.quantity_sold),
+               SUM(s.quantity_sold * p.price),
+               date(MIN(s.sale_date))
+        FROM sales s
+        JOIN products p ON s.product_id = p.id
+        GROUP BY year, week
+        ORDER BY year, week
+    ''')
+    weekly = pd.DataFrame(cursor.fetchall(), columns=['Year', 'Week', 'Quantity Sold', 'Revenue', 'Week Start'])
     return weekly
 
 # Function for AI-driven insights
-def get_insights():
-    products = get_products()
-    sales = get_sales()
+def get_insights(version):
+    products = get_products(version)
     
     # Top-selling products
-    top_products = sales.groupby('Name')['Quantity Sold'].sum().sort_values(ascending=False).head(3)
+    cursor.execute('''
+        SELECT p.name, SUM(s.quantity_sold) AS qty
+        FROM sales s
+        JOIN products p ON s.product_id = p.id
+        GROUP BY p.name
+        ORDER BY qty DESC
+        LIMIT 3
+    ''')
+    top_products = pd.DataFrame(cursor.fetchall(), columns=['Name', 'Quantity Sold']).set_index('Name')['Quantity Sold']
     
     # Low stock alerts
-    low_stock = products[products['Quantity'] < 5][['Name', 'Quantity', 'Stock Status']]
+    cursor.execute(f'''
+        SELECT name, quantity, {STOCK_STATUS_SQL}
+        FROM products
+        WHERE quantity < ?
+    ''', (LOW_STOCK_THRESHOLD,))
+    low_stock = pd.DataFrame(cursor.fetchall(), columns=['Name', 'Quantity', 'Stock Status'])
     
     # Sales trend (weekly)
-    weekly_sales = get_weekly_sales()
+    weekly_sales = get_weekly_sales(version)
     if len(weekly_sales) >= 2:
-        weekly_sales['Trend'] = weekly_sales['Quantity Sold'].diff().apply(
-            lambda x: 'Increasing' if x > 0 else 'Decreasing' if x < 0 else 'Stable'
+        d = weekly_sales['Quantity Sold'].diff().to_numpy()
+        weekly_sales['Trend'] = pd.Categorical.from_codes(
+            np.select([d > 0, d < 0], [0, 1], default=2).astype('int8'),
+            categories=['Increasing', 'Decreasing', 'Stable']
         )
     else:
         weekly_sales['Trend'] = 'Insufficient Data'
     
     # Revenue contribution
-    total_revenue = sales['Revenue'].sum()
-    revenue_contribution = sales.groupby('Name')['Revenue'].sum() / total_revenue * 100
+    cursor.execute('''
+        SELECT p.name, SUM(s.quantity_sold * p.price) * 100.0 / SUM(SUM(s.quantity_sold * p.price)) OVER ()
+        FROM sales s
+        JOIN products p ON s.product_id = p.id
+        GROUP BY p.name
+    ''')
+    revenue_contribution = pd.DataFrame(cursor.fetchall(), columns=['Name', 'Revenue']).set_index('Name')['Revenue']
     
-    # Restock recommendations
-    sales['Sale Date'] = pd.to_datetime(sales['Sale Date'])
-    recent_sales = sales[sales['Sale Date'] >= datetime.now() - timedelta(days=30)]
-    sales_velocity = recent_sales.groupby('Name')['Quantity Sold'].sum() / 30  # Units per day
-    restock_recommendations = products.merge(sales_velocity, on='Name', how='left').fillna(0)
-    restock_recommendations['Days to Depletion'] = restock_recommendations['Quantity'] / restock_recommendations['Quantity Sold']
-    restock_recommendations['Restock Urgency'] = restock_recommendations['Days to Depletion'].apply(
-        lambda x: 'Urgent' if x < 7 else 'Moderate' if x < 14 else 'Low' if x >= 14 else 'No Sales'
+    # Restock recommendations (units sold per day over the last 30 days)
+    cursor.execute('''
+        SELECT p.name, SUM(s.quantity_sold) / 30.0
+        FROM sales s
+        JOIN products p ON s.product_id = p.id
+        WHERE s.sale_ts >= ?
+        GROUP BY p.name
+    ''', (int(datetime.now().timestamp()) - 30 * 86400,))
+    # Force float: with no recent sales the empty result would otherwise be object dtype
+    sales_velocity = pd.DataFrame(cursor.fetchall(), columns=['Name', 'Quantity Sold']).set_index('Name')['Quantity Sold'].astype('float64')
+    qty = products['Quantity'].to_numpy()
+    vel = sales_velocity.reindex(products['Name'], fill_value=0).to_numpy()
+    days = np.divide(qty, vel, out=np.full_like(qty, np.inf, dtype='f8'), where=vel > 0)
+    urgency = pd.Categorical.from_codes(
+        np.select([vel == 0, days < 7, days < 14], [3, 0, 1], default=2).astype('int8'),
+        categories=['Urgent', 'Moderate', 'Low', 'No Sales']
     )
+    restock_recommendations = pd.DataFrame({
+        'Name': products['Name'],
+        'Quantity': qty,
+        'Days to Depletion': days,
+        'Restock Urgency': urgency
+    })
     
     return top_products, low_stock, weekly_sales, revenue_contribution, restock_recommendations
 
@@ -143,50 +310,51 @@ if page == "Add Product":
 # View Products Page
 elif page == "View Products":
     st.header("Product Inventory")
-    products = get_products()
     search = st.text_input("Search by Product Name")
     if search:
-        products = products[products['Name'].str.contains(search, case=False, na=False)]
+        # Fetch one extra row to tell whether the results were cut off
+        products = search_products(db_version(), search, limit=SEARCH_LIMIT + 1)
+        if len(products) > SEARCH_LIMIT:
+            products = products.iloc[:SEARCH_LIMIT]
+            st.info(f"Showing the first {SEARCH_LIMIT} matches. Refine the search to narrow the list; "
+                    "the CSV export includes every match.")
+    else:
+        products = get_products(db_version())
     # Color-code stock status
     def color_stock_status(val):
-        color = 'red' if val == 'Out of Stock' else 'orange' if val == 'Low Stock' else 'green'
+        color = {STOCK_STATUSES[0]: 'red', STOCK_STATUSES[1]: 'orange'}.get(val, 'green')
         return f'background-color: {color}'
     st.dataframe(products.style.applymap(color_stock_status, subset=['Stock Status']), use_container_width=True)
     # Export to CSV
     if st.button("Export Inventory to CSV"):
-        products.to_csv('inventory_export.csv', index=False)
+        export_inventory('inventory_export.csv', search)
         st.success("Inventory exported to 'inventory_export.csv'")
 
 # Record Sale Page
 elif page == "Record Sale":
     st.header("Record a Sale")
-    products = get_products()
-    product_dict = {row['Name']: row['ID'] for _, row in products.iterrows()}
+    products = get_products(db_version())
+    product_dict = dict(zip(products['Name'].to_numpy(), products['ID'].to_numpy()))
     with st.form("record_sale_form"):
         product_name = st.selectbox("Select Product", list(product_dict.keys()))
         quantity_sold = st.number_input("Quantity Sold", min_value=1, step=1)
         submit = st.form_submit_button("Record Sale")
         if submit:
-            product_id = product_dict[product_name]
-            available_quantity = products[products['ID'] == product_id]['Quantity'].iloc[0]
-            if quantity_sold <= available_quantity:
-                record_sale(product_id, quantity_sold)
-            else:
-                st.error(f"Insufficient stock! Available: {available_quantity}")
+            record_sale(product_dict[product_name], quantity_sold)
 
 # View Sales Page
 elif page == "View Sales":
     st.header("Sales History")
-    sales = get_sales()
+    sales = get_sales(db_version())
     st.dataframe(sales, use_container_width=True)
     if st.button("Export Sales to CSV"):
-        sales.to_csv('sales_export.csv', index=False)
+        export_sales('sales_export.csv')
         st.success("Sales exported to 'sales_export.csv'")
 
 # Weekly Sales Page
 elif page == "Weekly Sales":
     st.header("Weekly Sales")
-    weekly_sales = get_weekly_sales()
+    weekly_sales = get_weekly_sales(db_version())
     st.dataframe(weekly_sales, use_container_width=True)
     # Plot weekly sales trend
     if not weekly_sales.empty:
@@ -196,7 +364,7 @@ elif page == "Weekly Sales":
 # Insights Page
 elif page == "Insights":
     st.header("AI-Driven Insights")
-    top_products, low_stock, weekly_sales, revenue_contribution, restock_recommendations = get_insights()
+    top_products, low_stock, weekly_sales, revenue_contribution, restock_recommendations = get_insights(db_version())
     
     st.subheader("Top-Selling Products")
     st.write(top_products)
@@ -217,6 +385,3 @@ elif page == "Insights":
     
     st.subheader("Restock Recommendations")
     st.dataframe(restock_recommendations[['Name', 'Quantity', 'Days to Depletion', 'Restock Urgency']], use_container_width=True)
-
-# Close database connection
-conn.close()
\ No newline at end of file